@@ -1,12 +1,16 @@
+import asyncio
+import contextlib
+import enum
+import functools
 import logging
 import sqlite3
+import threading
 import os 
 import time
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
-from apscheduler.schedulers.background import BackgroundScheduler
-import pytz
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 # Enable logging
 logging.basicConfig(
@@ -15,317 +19,53 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+_UTC = timezone.utc
+
 # Database setup
 DB_NAME = "taskpulse.db"
 
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            schedule TEXT DEFAULT '10:00,14:00,18:00',
-            max_reminders INTEGER DEFAULT 3,
-            stop_on_response BOOLEAN DEFAULT TRUE
-        )
-    ''')
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS tasks (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            text TEXT,
-            created_at TIMESTAMP,
-            status TEXT DEFAULT 'active',  -- active, completed, skipped, stopped
-            last_reminded TIMESTAMP NULL,
-            reminder_count INTEGER DEFAULT 0
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
-init_db()
-
-# Helper functions
-def get_user_prefs(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT schedule, max_reminders, stop_on_response FROM users WHERE user_id = ?", (user_id,))
-    row = c.fetchone()
-    conn.close()
-    if row:
-        return {
-            'schedule': row[0].split(',') if row[0] else ['10:00', '14:00', '18:00'],
-            'max_reminders': row[1],
-            'stop_on_response': row[2]
-        }
-    return {'schedule': ['10:00', '14:00', '18:00'], 'max_reminders': 3, 'stop_on_response': True}
-
-def add_user_if_missing(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
-    conn.commit()
-    conn.close()
-
-def add_task(user_id, text):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("INSERT INTO tasks (user_id, text, created_at) VALUES (?, ?, ?)",
-              (user_id, text.strip(), datetime.now()))
-    task_id = c.lastrowid
-    conn.commit()
-    conn.close()
-    return task_id
-
-def get_active_tasks(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("""
-        SELECT id, text, reminder_count, last_reminded 
-        FROM tasks 
-        WHERE user_id = ? AND status = 'active'
-    """, (user_id,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
-
-def update_task_status(task_id, status, new_reminder_count=None, new_last_reminded=None):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    if new_reminder_count is not None:
-        c.execute("UPDATE tasks SET reminder_count = ?, last_reminded = ? WHERE id = ?", 
-                  (new_reminder_count, new_last_reminded, task_id))
-    c.execute("UPDATE tasks SET status = ? WHERE id = ?", (status, task_id))
-    conn.commit()
-    conn.close()
-
-def get_task_text(task_id):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT text FROM tasks WHERE id = ?", (task_id,))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else ""
-
-def get_tz_time(time_str, tz_name="UTC"):
-    """Convert HH:MM string to timezone-aware datetime for today"""
-    now = datetime.now(pytz.timezone(tz_name))
-    hour, minute = map(int, time_str.split(':'))
-    return now.replace(hour=hour, minute=minute, second=0, microsecond=0)
-
-async def send_reminders(context: ContextTypes.DEFAULT_TYPE):
-    """Scheduled job: check and send reminders to all users"""
-    users_to_remind = {}
-    now = datetime.now(pytz.UTC)
-    
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    
-    # Get all active users and their schedules
-    c.execute("SELECT user_id, schedule FROM users")
-    for user_id, schedule_str in c.fetchall():
-        schedule = schedule_str.split(',') if schedule_str else ['10:00', '14:00', '18:00']
-        for timestr in schedule:
-            try:
-                remind_time = get_tz_time(timestr, "UTC")
-                # If today's reminder time has passed, skip
-                if remind_time > now:
-                    continue
-                # Check if we already sent a reminder today for this user+time
-                # We'll check all tasks and see which ones are due for a reminder
-                c.execute("""
-                    SELECT id, text, reminder_count FROM tasks 
-                    WHERE user_id = ? AND status = 'active' AND reminder_count < ?
-                """, (user_id, 3))  # Max 3 reminders per task per day
-                tasks = c.fetchall()
-                if tasks:
-                    if user_id not in users_to_remind:
-                        users_to_remind[user_id] = []
-                    users_to_remind[user_id].extend(tasks)
-            except Exception as e:
-                logger.error(f"Error parsing time {timestr}: {e}")
-    
-    conn.close()
-    
-    for user_id, tasks in users_to_remind.items():
-        # Only send one reminder per user per scheduler run (to avoid spam)
-        if tasks:
-            task_id, task_text, count = tasks[0]  # Pick first task
-            keyboard = [
-                [InlineKeyboardButton("✅ Completed", callback_data=f"complete:{task_id}")],
-                [InlineKeyboardButton("⏳ Skip for today", callback_data=f"skip:{task_id}")],
-                [InlineKeyboardButton("⏱️ Delay 2h", callback_data=f"delay:{task_id}")],
-                [InlineKeyboardButton("🛑 Stop Reminders Forever", callback_data=f"stopforever:{task_id}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=f"⏰ Task Reminder: \"{task_text}\"\n\nWhat are you doing right now?",
-                    reply_markup=reply_markup
-                )
-                # Log that we reminded this task
-                update_task_status(task_id, 'active', count + 1, now.isoformat())
-                logger.info(f"Sent reminder to {user_id} for task {task_id}")
-            except Exception as e:
-                logger.error(f"Failed to send reminder to {user_id}: {e}")
-
-# Handle button presses
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    data = query.data
-    parts = data.split(":")
-    action = parts[0]
-    task_id = int(parts[1])
-    user_id = query.from_user.id
-
-    task_text = get_task_text(task_id)
-
-    if action == "complete":
-        update_task_status(task_id, "completed")
-        await query.edit_message_text(f"✅ Great job! Task '{task_text}' marked as completed.")
-        
-    elif action == "skip":
-        update_task_status(task_id, "skipped")  # Will be reactivated tomorrow
-        await query.edit_message_text(f"⏳ Skipped '{task_text}' for today. I'll remind you again tomorrow!")
-
-    elif action == "delay":
-        # Delay by 2 hours
-        delay_until = datetime.now(pytz.UTC) + timedelta(hours=2)
-        update_task_status(task_id, "active", 0, delay_until.isoformat())  # Reset counter
-        await query.edit_message_text(f"⏱️ Delayed '{task_text}' until {delay_until.strftime('%H:%M')}.")
-
-    elif action == "stopforever":
-        update_task_status(task_id, "stopped")
-        await query.edit_message_text(f"🛑 Permanently stopped reminders for '{task_text}'. You're free!")
-
-# Commands
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    add_user_if_missing(user_id)
-    prefs = get_user_prefs(user_id)
-    schedule_str = ", ".join(prefs['schedule'])
-    max_reminders = prefs['max_reminders']
-    stop_on_response = prefs['stop_on_response']
-
-    await update.message.reply_text(
-        f"👋 Welcome to @TaskPulseBot!\n\n"
-        f"I'll remind you about your tasks intelligently.\n\n"
-        f"📌 *Rules*:\n"
-        f"- I'll remind you up to {max_reminders} times per task per day.\n"
-        f"- Reminders are sent at: {schedule_str}\n"
-        f"- If you respond to any option, I'll stop reminding you for today.\n"
-        f"- 'Skip for today' → I'll remind you again tomorrow.\n"
-        f"- 'Stop Reminders Forever' → Never bothered again.\n\n"
-        f"✨ Commands:\n"
-        f"/add [task] — Add a task\n"
-        f"/schedule [times] — Set reminder times (e.g., /schedule 09:00,15:00)\n"
-        f"/maxreminders N — Change max reminders per day (default: 3)\n"
-        f"/stoponresponse [on/off] — Toggle auto-stop after response (default: on)\n"
-        f"/list — View active tasks\n"
-        f"/clear — Clear all tasks\n\n"
-        f"Type /add to begin!",
-        parse_mode="Markdown"
+class TaskStatus(enum.IntEnum):
+    """Values stored in tasks.status"""
+    ACTIVE = 0
+    COMPLETED = 1
+    SKIPPED = 2
+    STOPPED = 3
+    CLEARED = 4
+
+TASKS_TABLE_SQL = f'''
+    CREATE TABLE IF NOT EXISTS tasks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        text TEXT,
+        created_at TIMESTAMP,
+        status INTEGER DEFAULT {TaskStatus.ACTIVE.value}
+            CHECK (status BETWEEN {min(TaskStatus).value} AND {max(TaskStatus).value}),  -- TaskStatus
+        last_reminded TIMESTAMP NULL,
+        reminder_count INTEGER DEFAULT 0
     )
-
-async def add_task_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    if not context.args:
-        await update.message.reply_text("Usage: /add [your task here]")
-        return
-    task_text = " ".join(context.args)
-    task_id = add_task(user_id, task_text)
-    await update.message.reply_text(f"✅ Added: \"{task_text}\"")
-
-async def list_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    tasks = get_active_tasks(user_id)
-    if not tasks:
-        await update.message.reply_text("No active tasks. Use /add to create one!")
-        return
-    msg = "📝 Your active tasks:\n"
-    for tid, text, count, _ in tasks:
-        msg += f"\n• {text} ({count}/3 reminders used)"
-    await update.message.reply_text(msg)
-
-async def schedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    if not context.args:
-        await update.message.reply_text("Usage: /schedule 09:00,14:00,18:00")
-        return
-    times_str = ",".join(context.args)
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("UPDATE users SET schedule = ? WHERE user_id = ?", (times_str, user_id))
-    conn.commit()
-    conn.close()
-    await update.message.reply_text(f"📅 Reminder times set to: {times_str}")
-
-async def maxreminders_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    if not context.args or not context.args[0].isdigit():
-        await update.message.reply_text("Usage: /maxreminders 3 (number between 1-5)")
-        return
-    max_rem = int(context.args[0])
-    if max_rem < 1 or max_rem > 5:
-        await update.message.reply_text("Please choose between 1 and 5 reminders per day.")
-        return
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("UPDATE users SET max_reminders = ? WHERE user_id = ?", (max_rem, user_id))
-    conn.commit()
-    conn.close()
-    await update.message.reply_text(f"✅ Max reminders per task set to: {max_rem}")
-
-async def stoponresponse_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    if not context.args or context.args[0].lower() not in ['on', 'off']:
-        await update.message.reply_text("Usage: /stoponresponse on|off")
-        return
-    flag = context.args[0].lower() == 'on'
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("UPDATE users SET stop_on_response = ? WHERE user_id = ?", (flag, user_id))
-    conn.commit()
-    conn.close()
-    await update.message.reply_text(f"🔄 Auto-stop after response: {'ON' if flag else 'OFF'}")
-
-async def clear_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("UPDATE tasks SET status = 'cleared' WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
-    await update.message.reply_text("🗑️ All tasks cleared!")
-
-# Main function
-def main():
-    # Initialize bot
-    import logging
-import sqlite3
-import time
-from datetime import datetime, timedelta
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
-from apscheduler.schedulers.background import BackgroundScheduler
-import pytz
-
-# Enable logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
-
-# Database setup
-DB_NAME = "taskpulse.db"
+'''
+
+def get_conn(readonly=False):
+    """Open a connection with the per-connection PRAGMAs applied"""
+    if readonly:
+        conn = sqlite3.connect(f"file:{DB_NAME}?mode=ro", uri=True,
+                               check_same_thread=False, isolation_level=None)
+    else:
+        conn = sqlite3.connect(DB_NAME, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA busy_timeout=5000;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA cache_size=-64000;")
+    conn.execute("PRAGMA mmap_size=268435456;")
+    return conn
 
 def init_db():
     conn = sqlite3.connect(DB_NAME)
+    # WAL is persistent in the db file, so it only has to be set once here
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA busy_timeout=5000;")
     c = conn.cursor()
+    c.execute("BEGIN")
     c.execute('''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
@@ -334,29 +74,74 @@ def init_db():
             stop_on_response BOOLEAN DEFAULT TRUE
         )
     ''')
+    c.execute(TASKS_TABLE_SQL)
+    # Older databases stored status as TEXT; rebuild those with the names
+    # mapped to TaskStatus. Unknown or NULL legacy values are treated as
+    # inactive (STOPPED) rather than guessing they should be reminded again.
+    columns = {row[1]: row[2] for row in c.execute("PRAGMA table_info(tasks)")}
+    if columns['status'].upper() == 'TEXT':
+        c.execute("ALTER TABLE tasks RENAME TO tasks_text_status")
+        c.execute(TASKS_TABLE_SQL)
+        cases = " ".join(f"WHEN '{status.name.lower()}' THEN {status.value}" for status in TaskStatus)
+        c.execute(f'''
+            INSERT INTO tasks (id, user_id, text, created_at, status, last_reminded, reminder_count)
+            SELECT id, user_id, text, created_at,
+                   CASE status {cases} ELSE {TaskStatus.STOPPED.value} END,
+                   last_reminded, reminder_count
+            FROM tasks_text_status
+        ''')
+        c.execute("DROP TABLE tasks_text_status")
+    # Covering index for the per-user active task lookups (list + reminders)
     c.execute('''
-        CREATE TABLE IF NOT EXISTS tasks (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            text TEXT,
-            created_at TIMESTAMP,
-            status TEXT DEFAULT 'active',  -- active, completed, skipped, stopped
-            last_reminded TIMESTAMP NULL,
-            reminder_count INTEGER DEFAULT 0
-        )
+        CREATE INDEX IF NOT EXISTS idx_tasks_user_active
+        ON tasks(user_id, status, reminder_count, last_reminded, id, text)
     ''')
     conn.commit()
     conn.close()
 
 init_db()
 
+# Shared connections, reused for the whole lifetime of the bot. A sqlite3
+# connection must not be used by two threads at once, so each has a lock.
+_LOCK = threading.Lock()
+_CONN = get_conn()
+# Read-only connection for the scheduler so its reads never wait on writers
+_READ_LOCK = threading.Lock()
+_READ_CONN = get_conn(readonly=True)
+
+@contextlib.contextmanager
+def write_transaction():
+    """Run a multi-row write on _CONN inside BEGIN IMMEDIATE ... COMMIT"""
+    # _CONN is in autocommit mode, so we take the write lock up front
+    # ourselves instead of relying on the driver's implicit deferred BEGIN
+    with _LOCK:
+        _CONN.execute("BEGIN IMMEDIATE")
+        try:
+            yield _CONN
+            _CONN.execute("COMMIT")
+        except BaseException:
+            # Also covers a failed COMMIT, which leaves the transaction open;
+            # SQLite may already have rolled back on its own (e.g. IOERR)
+            if _CONN.in_transaction:
+                _CONN.execute("ROLLBACK")
+            raise
+
+# Telegram's bot API allows about 30 messages per second across all chats
+SEND_RATE_PER_SECOND = 30
+_SEND_SLOTS = asyncio.Semaphore(SEND_RATE_PER_SECOND)
+
+# (hour, minute) -> {user_id: None} of users with a reminder at that time, see
+# refresh_schedule_index(); dict buckets keep insertion order and O(1) removal
+_SCHEDULE_INDEX = {}
+# Last minute send_reminders handled, so a late or dropped tick is caught up
+# on the next one instead of skipping (or repeating) a minute
+_LAST_REMINDER_MINUTE = None
+
 # Helper functions
 def get_user_prefs(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT schedule, max_reminders, stop_on_response FROM users WHERE user_id = ?", (user_id,))
-    row = c.fetchone()
-    conn.close()
+    with _LOCK:
+        row = _CONN.execute("SELECT schedule, max_reminders, stop_on_response FROM users WHERE user_id = ?",
+                            (user_id,)).fetchone()
     if row:
         return {
             'schedule': row[0].split(',') if row[0] else ['10:00', '14:00', '18:00'],
@@ -366,145 +151,234 @@ def get_user_prefs(user_id):
     return {'schedule': ['10:00', '14:00', '18:00'], 'max_reminders': 3, 'stop_on_response': True}
 
 def add_user_if_missing(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
-    conn.commit()
-    conn.close()
+    with _LOCK:
+        c = _CONN.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+        if not c.rowcount:
+            return
+        # Read back the column default rather than repeating it here
+        schedule_str, = _CONN.execute("SELECT schedule FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    # Only the new user changed, so add them rather than rebuilding the index
+    index_user_schedule(user_id, None, schedule_str)
 
 def add_task(user_id, text):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("INSERT INTO tasks (user_id, text, created_at) VALUES (?, ?, ?)",
-              (user_id, text.strip(), datetime.now()))
-    task_id = c.lastrowid
-    conn.commit()
-    conn.close()
-    return task_id
+    with _LOCK:
+        c = _CONN.execute("INSERT INTO tasks (user_id, text, created_at) VALUES (?, ?, ?)",
+                          (user_id, text.strip(), datetime.now()))
+        return c.lastrowid
 
 def get_active_tasks(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("""
-        SELECT id, text, reminder_count, last_reminded 
-        FROM tasks 
-        WHERE user_id = ? AND status = 'active'
-    """, (user_id,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    with _LOCK:
+        return _CONN.execute("""
+            SELECT id, text, reminder_count, last_reminded 
+            FROM tasks 
+            WHERE user_id = ? AND status = ?
+        """, (user_id, TaskStatus.ACTIVE)).fetchall()
+
+_UPDATE_STATUS_SQL = """
+    UPDATE tasks
+    SET status = ?,
+        reminder_count = COALESCE(?, reminder_count),
+        last_reminded = COALESCE(?, last_reminded)
+    WHERE id = ?
+"""
+# UPDATE ... RETURNING needs SQLite 3.35+
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
 
 def update_task_status(task_id, status, new_reminder_count=None, new_last_reminded=None):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    if new_reminder_count is not None:
-        c.execute("UPDATE tasks SET reminder_count = ?, last_reminded = ? WHERE id = ?", 
-                  (new_reminder_count, new_last_reminded, task_id))
-    c.execute("UPDATE tasks SET status = ? WHERE id = ?", (status, task_id))
-    conn.commit()
-    conn.close()
-
-def get_task_text(task_id):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT text FROM tasks WHERE id = ?", (task_id,))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else ""
+    """Update a task and return its text ("" if there is no such task)"""
+    params = (status, new_reminder_count, new_last_reminded, task_id)
+    if _HAS_RETURNING:
+        with _LOCK:
+            # fetchall() so the statement runs to completion and releases the write lock
+            rows = _CONN.execute(_UPDATE_STATUS_SQL + " RETURNING text", params).fetchall()
+    else:
+        with write_transaction() as conn:
+            rows = conn.execute("SELECT text FROM tasks WHERE id = ?", (task_id,)).fetchall()
+            conn.execute(_UPDATE_STATUS_SQL, params)
+    return rows[0][0] if rows else ""
+
+# The bulk update record_reminders runs for each tick's reminders
+_UPDATE_REMINDER_SQL = "UPDATE tasks SET reminder_count = ?, last_reminded = ? WHERE id = ?"
+
+def record_reminders(rows):
+    """Store (reminder_count, last_reminded, task_id) rows in one transaction"""
+    with write_transaction() as conn:
+        conn.executemany(_UPDATE_REMINDER_SQL, rows)
+
+# Stays below SQLITE_MAX_VARIABLE_NUMBER (999 before SQLite 3.32), leaving room for the status
+_USER_CHUNK_SIZE = 900
+
+def get_remindable_tasks(user_ids):
+    """Return {user_id: [(task_id, text, reminder_count), ...]} for the remindable tasks of user_ids"""
+    tasks_by_user = {}
+    with _READ_LOCK:
+        for start in range(0, len(user_ids), _USER_CHUNK_SIZE):
+            chunk = user_ids[start:start + _USER_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            # Group straight off the cursor rather than materialising every row first
+            rows = _READ_CONN.execute(f"""
+                SELECT u.user_id, t.id, t.text, t.reminder_count
+                FROM users u JOIN tasks t ON t.user_id = u.user_id
+                WHERE u.user_id IN ({placeholders})
+                  AND t.status = ? AND t.reminder_count < u.max_reminders
+                ORDER BY t.id
+            """, [*chunk, TaskStatus.ACTIVE])
+            for user_id, task_id, task_text, count in rows:
+                tasks_by_user.setdefault(user_id, []).append((task_id, task_text, count))
+    return tasks_by_user
+
+@functools.lru_cache(maxsize=1024)
+def parse_schedule(schedule_str):
+    """Parse a 'HH:MM,HH:MM' schedule into a tuple of (hour, minute) pairs"""
+    schedule = schedule_str.split(',') if schedule_str else ['10:00', '14:00', '18:00']
+    times = []
+    for timestr in schedule:
+        try:
+            hour, minute = map(int, timestr.split(':'))
+            if not (0 <= hour < 24 and 0 <= minute < 60):
+                raise ValueError("hour or minute out of range")
+            times.append((hour, minute))
+        except ValueError as e:
+            logger.error(f"Error parsing time {timestr}: {e}")
+    return tuple(times)
+
+def refresh_schedule_index():
+    """Rebuild the (hour, minute) -> [user_id] map send_reminders looks users up in"""
+    global _SCHEDULE_INDEX
+    index = {}
+    with _LOCK:
+        # Iterate the cursor directly; no need for a list of every user
+        for user_id, schedule_str in _CONN.execute("SELECT user_id, schedule FROM users"):
+            for hour_minute in parse_schedule(schedule_str):
+                index.setdefault(hour_minute, {})[user_id] = None
+    _SCHEDULE_INDEX = index
+
+def index_user_schedule(user_id, old_schedule_str, new_schedule_str):
+    """Move one user in _SCHEDULE_INDEX from their old schedule's times to the new one's"""
+    if old_schedule_str is not None:
+        for hour_minute in parse_schedule(old_schedule_str):
+            _SCHEDULE_INDEX.get(hour_minute, {}).pop(user_id, None)
+    for hour_minute in parse_schedule(new_schedule_str):
+        _SCHEDULE_INDEX.setdefault(hour_minute, {})[user_id] = None
+
+# Reminder keyboard, one button per row; only the task id varies per message
+_BUTTONS = (
+    ("✅ Completed", "complete"),
+    ("⏳ Skip for today", "skip"),
+    ("⏱️ Delay 2h", "delay"),
+    ("🛑 Stop Reminders Forever", "stopforever"),
+)
 
-def get_tz_time(time_str, tz_name="UTC"):
-    """Convert HH:MM string to timezone-aware datetime for today"""
-    now = datetime.now(pytz.timezone(tz_name))
-    hour, minute = map(int, time_str.split(':'))
-    return now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+async def wait_for_send_slot():
+    """Block until sending another message keeps us under SEND_RATE_PER_SECOND"""
+    await _SEND_SLOTS.acquire()
+    # Each slot is handed back one second after it was taken
+    asyncio.get_running_loop().call_later(1, _SEND_SLOTS.release)
+
+async def send_reminder(bot, user_id, task, now_iso):
+    """Send one task reminder; return its (reminder_count, last_reminded, task_id) row on success"""
+    task_id, task_text, count = task
+    reply_markup = InlineKeyboardMarkup(
+        [[InlineKeyboardButton(label, callback_data=f"{action}:{task_id}")] for label, action in _BUTTONS]
+    )
+    
+    try:
+        await wait_for_send_slot()
+        await bot.send_message(
+            chat_id=user_id,
+            text=f"⏰ Task Reminder: \"{task_text}\"\n\nWhat are you doing right now?",
+            reply_markup=reply_markup
+        )
+        logger.info(f"Sent reminder to {user_id} for task {task_id}")
+        # Log that we reminded this task
+        return (count + 1, now_iso, task_id)
+    except Exception as e:
+        logger.error(f"Failed to send reminder to {user_id}: {e}")
+        return None
+
+def due_minutes(now):
+    """Return (minutes after the last handled one up to now's, new value for _LAST_REMINDER_MINUTE)"""
+    current = now.replace(second=0, microsecond=0)
+    minute = current if _LAST_REMINDER_MINUTE is None else _LAST_REMINDER_MINUTE + timedelta(minutes=1)
+    minutes = []
+    while minute <= current:
+        minutes.append(minute)
+        minute += timedelta(minutes=1)
+    return minutes, max(current, _LAST_REMINDER_MINUTE or current)
 
 async def send_reminders(context: ContextTypes.DEFAULT_TYPE):
     """Scheduled job: check and send reminders to all users"""
-    users_to_remind = {}
-    now = datetime.now(pytz.UTC)
+    global _LAST_REMINDER_MINUTE
+    now = datetime.now(_UTC)
     
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    
-    # Get all active users and their schedules
-    c.execute("SELECT user_id, schedule FROM users")
-    for user_id, schedule_str in c.fetchall():
-        schedule = schedule_str.split(',') if schedule_str else ['10:00', '14:00', '18:00']
-        for timestr in schedule:
-            try:
-                remind_time = get_tz_time(timestr, "UTC")
-                # If today's reminder time has passed, skip
-                if remind_time > now:
-                    continue
-                # Check if we already sent a reminder today for this user+time
-                # We'll check all tasks and see which ones are due for a reminder
-                c.execute("""
-                    SELECT id, text, reminder_count FROM tasks 
-                    WHERE user_id = ? AND status = 'active' AND reminder_count < ?
-                """, (user_id, 3))  # Max 3 reminders per task per day
-                tasks = c.fetchall()
-                if tasks:
-                    if user_id not in users_to_remind:
-                        users_to_remind[user_id] = []
-                    users_to_remind[user_id].extend(tasks)
-            except Exception as e:
-                logger.error(f"Error parsing time {timestr}: {e}")
+    # Only users with a reminder time in a minute not handled yet are due;
+    # dict.fromkeys drops users due in several of them while keeping order
+    minutes, handled_up_to = due_minutes(now)
+    user_ids = list(dict.fromkeys(
+        user_id
+        for minute in minutes
+        for user_id in _SCHEDULE_INDEX.get((minute.hour, minute.minute), ())
+    ))
+    users_to_remind = {}
+    if user_ids:
+        # sqlite calls block, so keep them off the event loop
+        users_to_remind = await asyncio.to_thread(get_remindable_tasks, user_ids)
+    # Only mark the minutes handled once the lookup succeeded, so a failed
+    # lookup (e.g. database is locked) is retried on the next tick
+    _LAST_REMINDER_MINUTE = handled_up_to
+    if not users_to_remind:
+        return
     
-    conn.close()
+    # Every reminder of this tick is stamped with the same time
+    now_iso = now.isoformat()
+    # Fan out concurrently so one slow chat doesn't hold up everyone else
+    # Only send one reminder per user per scheduler run (to avoid spam)
+    results = await asyncio.gather(
+        *(send_reminder(context.bot, user_id, tasks[0], now_iso)  # Pick first task
+          for user_id, tasks in users_to_remind.items() if tasks),
+        return_exceptions=True
+    )
+    reminded = [row for row in results if isinstance(row, tuple)]
     
-    for user_id, tasks in users_to_remind.items():
-        # Only send one reminder per user per scheduler run (to avoid spam)
-        if tasks:
-            task_id, task_text, count = tasks[0]  # Pick first task
-            keyboard = [
-                [InlineKeyboardButton("✅ Completed", callback_data=f"complete:{task_id}")],
-                [InlineKeyboardButton("⏳ Skip for today", callback_data=f"skip:{task_id}")],
-                [InlineKeyboardButton("⏱️ Delay 2h", callback_data=f"delay:{task_id}")],
-                [InlineKeyboardButton("🛑 Stop Reminders Forever", callback_data=f"stopforever:{task_id}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=f"⏰ Task Reminder: \"{task_text}\"\n\nWhat are you doing right now?",
-                    reply_markup=reply_markup
-                )
-                # Log that we reminded this task
-                update_task_status(task_id, 'active', count + 1, now.isoformat())
-                logger.info(f"Sent reminder to {user_id} for task {task_id}")
-            except Exception as e:
-                logger.error(f"Failed to send reminder to {user_id}: {e}")
+    if reminded:
+        await asyncio.to_thread(record_reminders, reminded)
 
 # Handle button presses
+async def _handle_complete(task_id, query):
+    task_text = update_task_status(task_id, TaskStatus.COMPLETED)
+    await query.edit_message_text(f"✅ Great job! Task '{task_text}' marked as completed.")
+
+async def _handle_skip(task_id, query):
+    task_text = update_task_status(task_id, TaskStatus.SKIPPED)  # Will be reactivated tomorrow
+    await query.edit_message_text(f"⏳ Skipped '{task_text}' for today. I'll remind you again tomorrow!")
+
+async def _handle_delay(task_id, query):
+    # Delay by 2 hours
+    delay_until = datetime.now(_UTC) + timedelta(hours=2)
+    task_text = update_task_status(task_id, TaskStatus.ACTIVE, 0, delay_until.isoformat())  # Reset counter
+    await query.edit_message_text(f"⏱️ Delayed '{task_text}' until {delay_until.strftime('%H:%M')}.")
+
+async def _handle_stopforever(task_id, query):
+    task_text = update_task_status(task_id, TaskStatus.STOPPED)
+    await query.edit_message_text(f"🛑 Permanently stopped reminders for '{task_text}'. You're free!")
+
+# callback_data is "<action>:<task_id>", see _BUTTONS
+_ACTIONS = {
+    "complete": _handle_complete,
+    "skip": _handle_skip,
+    "delay": _handle_delay,
+    "stopforever": _handle_stopforever,
+}
+
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    data = query.data
-    parts = data.split(":")
-    action = parts[0]
-    task_id = int(parts[1])
-    user_id = query.from_user.id
-
-    task_text = get_task_text(task_id)
-
-    if action == "complete":
-        update_task_status(task_id, "completed")
-        await query.edit_message_text(f"✅ Great job! Task '{task_text}' marked as completed.")
-        
-    elif action == "skip":
-        update_task_status(task_id, "skipped")  # Will be reactivated tomorrow
-        await query.edit_message_text(f"⏳ Skipped '{task_text}' for today. I'll remind you again tomorrow!")
-
-    elif action == "delay":
-        # Delay by 2 hours
-        delay_until = datetime.now(pytz.UTC) + timedelta(hours=2)
-        update_task_status(task_id, "active", 0, delay_until.isoformat())  # Reset counter
-        await query.edit_message_text(f"⏱️ Delayed '{task_text}' until {delay_until.strftime('%H:%M')}.")
-
-    elif action == "stopforever":
-        update_task_status(task_id, "stopped")
-        await query.edit_message_text(f"🛑 Permanently stopped reminders for '{task_text}'. You're free!")
+    action, _, task_id = query.data.partition(":")
+    handler = _ACTIONS.get(action)
+    if handler is None or not task_id.isdigit():
+        logger.warning(f"Ignoring unknown callback data {query.data!r}")
+        return
+    await handler(int(task_id), query)
 
 # Commands
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -550,9 +424,10 @@ async def list_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not tasks:
         await update.message.reply_text("No active tasks. Use /add to create one!")
         return
+    max_reminders = get_user_prefs(user_id)['max_reminders']
     msg = "📝 Your active tasks:\n"
     for tid, text, count, _ in tasks:
-        msg += f"\n• {text} ({count}/3 reminders used)"
+        msg += f"\n• {text} ({count}/{max_reminders} reminders used)"
     await update.message.reply_text(msg)
 
 async def schedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -561,11 +436,12 @@ async def schedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: /schedule 09:00,14:00,18:00")
         return
     times_str = ",".join(context.args)
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("UPDATE users SET schedule = ? WHERE user_id = ?", (times_str, user_id))
-    conn.commit()
-    conn.close()
+    with _LOCK:
+        row = _CONN.execute("SELECT schedule FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        _CONN.execute("UPDATE users SET schedule = ? WHERE user_id = ?", (times_str, user_id))
+    if row:
+        # Only this user changed, so move them rather than rebuilding the index
+        index_user_schedule(user_id, row[0], times_str)
     await update.message.reply_text(f"📅 Reminder times set to: {times_str}")
 
 async def maxreminders_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -577,11 +453,8 @@ async def maxreminders_command(update: Update, context: ContextTypes.DEFAULT_TYP
     if max_rem < 1 or max_rem > 5:
         await update.message.reply_text("Please choose between 1 and 5 reminders per day.")
         return
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("UPDATE users SET max_reminders = ? WHERE user_id = ?", (max_rem, user_id))
-    conn.commit()
-    conn.close()
+    with _LOCK:
+        _CONN.execute("UPDATE users SET max_reminders = ? WHERE user_id = ?", (max_rem, user_id))
     await update.message.reply_text(f"✅ Max reminders per task set to: {max_rem}")
 
 async def stoponresponse_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -590,25 +463,24 @@ async def stoponresponse_command(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text("Usage: /stoponresponse on|off")
         return
     flag = context.args[0].lower() == 'on'
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("UPDATE users SET stop_on_response = ? WHERE user_id = ?", (flag, user_id))
-    conn.commit()
-    conn.close()
+    with _LOCK:
+        _CONN.execute("UPDATE users SET stop_on_response = ? WHERE user_id = ?", (flag, user_id))
     await update.message.reply_text(f"🔄 Auto-stop after response: {'ON' if flag else 'OFF'}")
 
 async def clear_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("UPDATE tasks SET status = 'cleared' WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    with write_transaction() as conn:
+        conn.execute("UPDATE tasks SET status = ? WHERE user_id = ?", (TaskStatus.CLEARED, user_id))
     await update.message.reply_text("🗑️ All tasks cleared!")
 
+async def start_scheduler(application):
+    """post_init hook: run the reminder job on the bot's own event loop"""
+    refresh_schedule_index()
+    # Check for due reminders at the start of every minute
+    scheduler = AsyncIOScheduler(timezone=_UTC)
+    scheduler.add_job(send_reminders, 'cron', second=0, args=[application])
+    scheduler.start()
 
-
-    # Main function
 # Main function
 def main():
     # Initialize bot using environment variable
@@ -616,7 +488,7 @@ def main():
     if not TOKEN:
         raise ValueError("❌ BOT_TOKEN environment variable not set!")
 
-    application = Application.builder().token(TOKEN).build()
+    application = Application.builder().token(TOKEN).post_init(start_scheduler).build()
 
     # Handlers
     application.add_handler(CommandHandler("start", start))
@@ -628,34 +500,6 @@ def main():
     application.add_handler(CommandHandler("clear", clear_tasks))
     application.add_handler(CallbackQueryHandler(button_handler))
 
-    # Schedule reminders every minute (to check if it's time to remind)
-    scheduler = BackgroundScheduler(timezone=pytz.UTC)
-    scheduler.add_job(send_reminders, 'interval', minutes=1, args=[application])
-    scheduler.start()
-
-    # Start bot
-    print("🚀 TaskPulseBot is running...")
-    application.run_polling()
-
-if __name__ == '__main__':
-    main()
-    application = Application.builder().token(TOKEN).build()
-
-    # Handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("add", add_task_command))
-    application.add_handler(CommandHandler("list", list_tasks))
-    application.add_handler(CommandHandler("schedule", schedule_command))
-    application.add_handler(CommandHandler("maxreminders", maxreminders_command))
-    application.add_handler(CommandHandler("stoponresponse", stoponresponse_command))
-    application.add_handler(CommandHandler("clear", clear_tasks))
-    application.add_handler(CallbackQueryHandler(button_handler))
-
-    # Schedule reminders every minute (to check if it's time to remind)
-    scheduler = BackgroundScheduler(timezone=pytz.UTC)
-    scheduler.add_job(send_reminders, 'interval', minutes=1, args=[application])
-    scheduler.start()
-
     # Start bot
     print("🚀 TaskPulseBot is running...")
     application.run_polling()